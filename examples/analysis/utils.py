@@ -1,14 +1,20 @@
 import time
 import numpy as np
-from typing import List, Dict
+from typing import Any, List, Dict, Tuple
 from dataclasses import dataclass
-from vllm import RequestOutput, LLMEngine
+from vllm import EngineArgs, RequestOutput, LLMEngine, SamplingParams
 import pandas as pd
 import os
 from queue import Queue
 from multiprocessing import Queue as MQueue
 import uuid
 import traceback
+import gc
+import contextlib
+
+# Parsed `seq_data/selected_seq.json` per base directory. Loaded once per
+# process instead of on every harness run.
+_SEQ_CACHE: Dict[str, Dict[str, str]] = {}
 
 
 @dataclass
@@ -57,6 +63,63 @@ class IterMetrics:
 
 class Utils:
 
+    @staticmethod
+    def build_requests(
+        BASE_DIR, min_tokens: int, max_tokens: int
+    ) -> Dict[int, Tuple[str, SamplingParams, int]]:
+        if BASE_DIR not in _SEQ_CACHE:
+            _SEQ_CACHE[BASE_DIR] = Utils.load_seq_from_file(
+                BASE_DIR, "seq_data", "selected_seq.json")
+        saved_seq = _SEQ_CACHE[BASE_DIR]
+        init_seq = {}
+        for p_len in saved_seq:
+            prompt_len = int(p_len)
+            prompt = saved_seq[p_len]
+            init_seq[prompt_len] = (
+                prompt,
+                SamplingParams(
+                    temperature=0.0,
+                    logprobs=1,
+                    min_tokens=min_tokens,
+                    max_tokens=max_tokens,
+                ),
+                prompt_len,
+            )
+        return init_seq
+
+    @staticmethod
+    def initialize_engine(engine_kwargs: Dict[str, Any]) -> LLMEngine:
+        """Initialize the LLMEngine from a prebuilt dict of engine
+        arguments."""
+        engine_args = EngineArgs(**engine_kwargs)
+        return LLMEngine.from_engine_args(engine_args)
+
+    @staticmethod
+    def skip_combination(df, batch_size, policy="fcfs", random_seed=10):
+        if df.shape[0] == 0:
+            return False
+        tmp = df[(df["batch_size"] == batch_size)
+                 & (df["policy"] == policy)
+                 & (df["random_seed"] == random_seed)]
+        if tmp.shape[0] == 0:
+            return False
+        return True
+
+    @staticmethod
+    def cleanup():
+        """Free the GPU and distributed state left by a dropped engine so
+        that a long-lived worker process can build the next engine of a
+        sweep."""
+        import torch
+        from vllm.distributed.parallel_state import destroy_model_parallel
+
+        destroy_model_parallel()
+        with contextlib.suppress(AssertionError):
+            torch.distributed.destroy_process_group()
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
     @staticmethod
     def calc_cv(prompt_lens: List[int]):
         if len(prompt_lens) == 0:
@@ -8,9 +8,10 @@ import pytest  # noqa
 from vllm.config import CacheConfig, LoRAConfig, SchedulerConfig
 from vllm.core.interfaces import AllocStatus
 from vllm.core.policy import PolicyFactory
-from vllm.core.scheduler import Scheduler, SchedulingBudget
+from vllm.core.scheduler import PreemptionMode, Scheduler, SchedulingBudget
 from vllm.lora.request import LoRARequest
 from vllm.sequence import Logprob, SequenceGroup, SequenceStatus
+from vllm.utils import Device
 
 from .utils import create_dummy_prompt
 
@@ -857,6 +858,125 @@ def test_schedule_swapped_blocks_to_copy():
     assert output.blocks_to_copy == [(2, 3)]
 
 
+def initialize_partial_swap_scheduler():
+    scheduler = initialize_scheduler()
+    scheduler.scheduler_config.swap_out_partial_tokens = True
+    scheduler.preemption_mode = PreemptionMode.SWAP
+    return scheduler
+
+
+def create_running_seq_group(scheduler,
+                             request_id: str,
+                             prompt_length: int = 16) -> SequenceGroup:
+    _, seq_group = create_dummy_prompt(request_id,
+                                       prompt_length=prompt_length,
+                                       block_size=4)
+    scheduler._allocate_and_set_running(seq_group)
+    append_new_token_seq_group(prompt_length, seq_group, 1)
+    return seq_group
+
+
+def get_block_devices(scheduler, seq_group: SequenceGroup) -> List[Device]:
+    seq = seq_group.get_seqs()[0]
+    return [
+        block.device
+        for block in scheduler.block_manager.block_tables[seq.seq_id]
+    ]
+
+
+def test_partial_swap_reclaims_leftover_blocks():
+    """
+    Verify the blocks a partial swap-out leaves on GPU are swapped out on the
+    next preemption instead of preempting another group.
+    """
+    scheduler = initialize_partial_swap_scheduler()
+    policy = PolicyFactory.get_policy(policy_name="fcfs")
+    # Both groups hold 4 blocks each, filling the GPU.
+    seq_group_a = create_running_seq_group(scheduler, "0")
+    seq_group_b = create_running_seq_group(scheduler, "1")
+    assert scheduler.block_manager.get_num_free_gpu_blocks() == 0
+
+    # "0" cannot append and is partially swapped out: 2 of its 4 blocks.
+    budget = create_token_budget()
+    _, output, _ = scheduler._schedule_running_preemption(
+        deque([seq_group_a, seq_group_b]), budget, None, policy)
+    assert output.swapped_out == [seq_group_a]
+    assert len(output.blocks_to_swap_out) == 2
+    assert output.decode_seq_groups[0].seq_group == seq_group_b
+    assert get_block_devices(scheduler, seq_group_a) == [
+        Device.CPU, Device.CPU, Device.GPU, Device.GPU
+    ]
+    assert set(scheduler.partial_swapped) == {"0"}
+    scheduler.swapped.extend(output.swapped_out)
+
+    # A new group takes the last free block and cannot append either.
+    seq_group_c = create_running_seq_group(scheduler, "2", prompt_length=4)
+    assert scheduler.block_manager.get_num_free_gpu_blocks() == 0
+    budget = create_token_budget()
+    remaining_running, output, _ = scheduler._schedule_running_preemption(
+        deque([seq_group_c]), budget, None, policy)
+    # The leftover blocks of "0" are reclaimed and "2" is scheduled.
+    assert len(remaining_running) == 0
+    assert output.swapped_out == []
+    assert output.preempted == []
+    assert output.decode_seq_groups[0].seq_group == seq_group_c
+    assert len(output.blocks_to_swap_out) == 2
+    assert get_block_devices(scheduler, seq_group_a) == [Device.CPU] * 4
+    assert not scheduler.partial_swapped
+    # "0" stays swapped out exactly once.
+    assert list(scheduler.swapped) == [seq_group_a]
+
+
+def test_partial_swapped_removed_on_swap_in_and_abort():
+    """
+    Verify partially swapped groups are dropped once swapped in or aborted.
+    """
+    scheduler = initialize_partial_swap_scheduler()
+    policy = PolicyFactory.get_policy(policy_name="fcfs")
+    seq_group_a = create_running_seq_group(scheduler, "0")
+    seq_group_b = create_running_seq_group(scheduler, "1")
+    scheduler.block_manager.can_append_slots = MagicMock()
+    scheduler.block_manager.can_append_slots.return_value = False
+
+    _, output, _ = scheduler._schedule_running_preemption(
+        deque([seq_group_a]), create_token_budget(), None, policy)
+    assert output.swapped_out == [seq_group_a]
+    assert set(scheduler.partial_swapped) == {"0"}
+    scheduler._swap_in(seq_group_a, [])
+    assert not scheduler.partial_swapped
+
+    _, output, _ = scheduler._schedule_running_preemption(
+        deque([seq_group_b]), create_token_budget(), None, policy)
+    assert output.swapped_out == [seq_group_b]
+    assert set(scheduler.partial_swapped) == {"1"}
+    scheduler.swapped.extend(output.swapped_out)
+    scheduler.abort_seq_group("1")
+    assert not scheduler.partial_swapped
+    assert scheduler._get_seq_group_from_partial_swapped() is None
+
+
+def test_partial_swap_not_recorded_on_recompute():
+    """
+    Verify a group preempted by recompute is not recorded as partially
+    swapped.
+    """
+    scheduler = initialize_partial_swap_scheduler()
+    scheduler.preemption_mode = PreemptionMode.RECOMPUTE
+    policy = PolicyFactory.get_policy(policy_name="fcfs")
+    seq_group = create_running_seq_group(scheduler, "0")
+    running = deque([seq_group])
+
+    scheduler.block_manager.can_append_slots = MagicMock()
+    scheduler.block_manager.can_append_slots.return_value = False
+
+    budget = create_token_budget()
+    _, output, _ = scheduler._schedule_running_preemption(
+        running, budget, None, policy)
+    assert output.preempted == [seq_group]
+    assert output.swapped_out == []
+    assert not scheduler.partial_swapped
+
+
 def test_scheduling_budget():
     TOKEN_BUDGET = 4
     MAX_SEQS = 4
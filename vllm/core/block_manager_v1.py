@@ -662,6 +662,29 @@ class BlockSpaceManagerV1(BlockSpaceManager):
         return [(cpu_block.block_number, gpu_block.block_number)
                 for cpu_block, gpu_block in mapping.items()]
 
+    def swap_out_remaining(
+            self, seq_group: SequenceGroup) -> List[Tuple[int, int]]:
+        """Swap out the blocks a partial swap-out left on GPU for the
+        sequences of an already swapped sequence group."""
+        # GPU block -> CPU block.
+        mapping: Dict[PhysicalTokenBlock, PhysicalTokenBlock] = {}
+        gpu_device = Device.GPU
+        for seq in seq_group.get_seqs(status=SequenceStatus.SWAPPED):
+            block_table = self.block_tables[seq.seq_id]
+            gpu_block_indices = [
+                block_indx for block_indx, block in enumerate(block_table)
+                if block.device == gpu_device
+            ]
+            swapped_out_blocks = self._swap_block_table(
+                [block_table[block_indx] for block_indx in gpu_block_indices],
+                self.gpu_allocator, self.cpu_allocator, mapping)
+            for block_indx, block in zip(gpu_block_indices,
+                                         swapped_out_blocks):
+                block_table[block_indx] = block
+
+        return [(cpu_block.block_number, gpu_block.block_number)
+                for cpu_block, gpu_block in mapping.items()]
+
     def _free_block_table(self, block_table: BlockTable) -> None:
         # when using a sliding window, each seq will only use up
         # to `self.block_sliding_window` blocks. When freeing
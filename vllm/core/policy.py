@@ -1,10 +1,13 @@
 from collections import deque
+from operator import attrgetter
 from typing import Deque
 import numpy as np
 
 from vllm.sequence import SequenceGroup
 import random
 
+_ARRIVAL_TIME = attrgetter("metrics.arrival_time")
+
 
 class Policy:
 
@@ -37,6 +40,15 @@ class FCFS(Policy):
     ) -> float:
         return now - seq_group.metrics.arrival_time
 
+    def sort_by_priority(
+        self,
+        now: float,
+        seq_groups: Deque[SequenceGroup],
+    ) -> Deque[SequenceGroup]:
+        # `now - arrival_time` descending is arrival_time ascending; sort on
+        # the attribute directly instead of calling get_priority per group.
+        return deque(sorted(seq_groups, key=_ARRIVAL_TIME))
+
 
 class InferSchedule(Policy):
 
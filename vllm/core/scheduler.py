@@ -1,11 +1,14 @@
 import enum
+import heapq
 import os
 import random
 import time
 from collections import deque
-from queue import PriorityQueue
-from dataclasses import dataclass, field
-from typing import Deque, Dict, Iterable, List, Optional, Set, Tuple, Union, PriorityQueue
+from dataclasses import dataclass
+from itertools import chain
+from operator import attrgetter
+from typing import (Callable, Deque, Dict, Iterable, List, Optional, Set,
+                    Tuple, Union)
 
 from vllm.config import CacheConfig, LoRAConfig, SchedulerConfig
 from vllm.core.interfaces import AllocStatus, BlockSpaceManager
@@ -19,10 +22,12 @@ logger = init_logger(__name__)
 
 # Test-only. If configured, decode is preempted with
 # ARTIFICIAL_PREEMPTION_PROB% probability.
-ENABLE_ARTIFICIAL_PREEMPT = bool(
-    os.getenv("VLLM_TEST_ENABLE_ARTIFICIAL_PREEMPT", False))  # noqa
+ENABLE_ARTIFICIAL_PREEMPT = os.getenv("VLLM_TEST_ENABLE_ARTIFICIAL_PREEMPT",
+                                      "0").lower() in ("1", "true", "yes")
 ARTIFICIAL_PREEMPTION_PROB = 0.5
 ARTIFICIAL_PREEMPTION_MAX_CNT = 500
+# ARTIFICIAL_PREEMPTION_PROB scaled to random.getrandbits(32).
+_ARTIFICIAL_PREEMPTION_THRESHOLD = int(ARTIFICIAL_PREEMPTION_PROB * 2**32)
 
 
 class PreemptionMode(enum.Enum):
@@ -66,6 +71,25 @@ class PreemptionReason(enum.Enum):
     NONE = enum.auto()
 
 
+# Indexed by (token budget exhausted) << 1 | (sequence budget exhausted).
+_PREEMPTION_REASONS = (
+    PreemptionReason.NONE,
+    PreemptionReason.SEQ_NUM_EXHAUSTED,
+    PreemptionReason.BUDGET_EXHAUSTED,
+    PreemptionReason.ALL_EXHAUSTED,
+)
+
+# Sort key of SchedulerOutputs._sort_by_lora_ids. attrgetter builds the key
+# tuple in C instead of calling a Python lambda per scheduled group.
+_LORA_SORT_KEY = attrgetter("seq_group.lora_int_id", "seq_group.request_id")
+# Unwraps a ScheduledSequenceGroup when moving groups back into self.running.
+_SEQ_GROUP = attrgetter("seq_group")
+
+# Flags for the budgets a request id is counted in by SchedulingBudget.
+_COUNTED_TOKENS = 1
+_COUNTED_SEQS = 2
+
+
 @dataclass
 class SchedulingBudget:
     """The available slots for scheduling.
@@ -77,58 +101,70 @@ class SchedulingBudget:
     happen if we only have chunked prefill scheduling, we can remove this
     feature from the API when chunked prefill is enabled by default.
     """
+    # The counters are set in __post_init__ rather than declared as fields
+    # with defaults, which __slots__ does not allow on Python < 3.10.
+    __slots__ = ("token_budget", "max_num_seqs", "_request_ids_counted",
+                 "_num_batched_tokens", "_num_curr_seqs")
     token_budget: int
     max_num_seqs: int
-    _requeset_ids_num_batched_tokens: Set[str] = field(default_factory=set)
-    _requeset_ids_num_curr_seqs: Set[str] = field(default_factory=set)
-    _num_batched_tokens: int = 0
-    _num_curr_seqs: int = 0
+
+    def __post_init__(self):
+        # request_id -> bitmask of the budgets it is counted in
+        # (_COUNTED_TOKENS and/or _COUNTED_SEQS).
+        self._request_ids_counted: Dict[str, int] = {}
+        self._num_batched_tokens: int = 0
+        self._num_curr_seqs: int = 0
 
     def can_schedule_infer(self, *, num_new_tokens: int,
                            num_new_seqs: int) -> PreemptionReason:
-        request_tokens = self.num_batched_tokens + num_new_tokens
-        request_seqs = self.num_curr_seqs + num_new_seqs
-        if request_tokens >= self.token_budget and request_seqs >= self.max_num_seqs:
-            return PreemptionReason.ALL_EXHAUSTED
-        elif request_tokens >= self.token_budget and request_seqs < self.max_num_seqs:
-            return PreemptionReason.BUDGET_EXHAUSTED
-        elif request_tokens <= self.token_budget and request_seqs >= self.max_num_seqs:
-            return PreemptionReason.SEQ_NUM_EXHAUSTED
-        else:
-            return PreemptionReason.NONE
+        tokens_exhausted = (self._num_batched_tokens + num_new_tokens
+                            >= self.token_budget)
+        seqs_exhausted = (self._num_curr_seqs + num_new_seqs
+                          >= self.max_num_seqs)
+        return _PREEMPTION_REASONS[tokens_exhausted << 1 | seqs_exhausted]
 
     def can_schedule(self, *, num_new_tokens: int, num_new_seqs: int):
         # assert num_new_tokens != 0
         # assert num_new_seqs != 0
-        return (self.num_batched_tokens + num_new_tokens <= self.token_budget
-                and self.num_curr_seqs + num_new_seqs <= self.max_num_seqs)
+        return (self._num_batched_tokens + num_new_tokens <= self.token_budget
+                and self._num_curr_seqs + num_new_seqs <= self.max_num_seqs)
 
     def remaining_token_budget(self):
-        return self.token_budget - self.num_batched_tokens
+        return self.token_budget - self._num_batched_tokens
 
     def add_num_batched_tokens(self, req_id: str, num_batched_tokens: int):
-        if req_id in self._requeset_ids_num_batched_tokens:
+        counted = self._request_ids_counted.get(req_id, 0)
+        if counted & _COUNTED_TOKENS:
             return
 
-        self._requeset_ids_num_batched_tokens.add(req_id)
+        self._request_ids_counted[req_id] = counted | _COUNTED_TOKENS
         self._num_batched_tokens += num_batched_tokens
 
     def subtract_num_batched_tokens(self, req_id: str,
                                     num_batched_tokens: int):
-        if req_id in self._requeset_ids_num_batched_tokens:
-            self._requeset_ids_num_batched_tokens.remove(req_id)
+        counted = self._request_ids_counted.get(req_id, 0)
+        if counted & _COUNTED_TOKENS:
+            if counted == _COUNTED_TOKENS:
+                del self._request_ids_counted[req_id]
+            else:
+                self._request_ids_counted[req_id] = _COUNTED_SEQS
             self._num_batched_tokens -= num_batched_tokens
 
     def add_num_seqs(self, req_id: str, num_curr_seqs: int):
-        if req_id in self._requeset_ids_num_curr_seqs:
+        counted = self._request_ids_counted.get(req_id, 0)
+        if counted & _COUNTED_SEQS:
             return
 
-        self._requeset_ids_num_curr_seqs.add(req_id)
+        self._request_ids_counted[req_id] = counted | _COUNTED_SEQS
         self._num_curr_seqs += num_curr_seqs
 
     def subtract_num_seqs(self, req_id: str, num_curr_seqs: int):
-        if req_id in self._requeset_ids_num_curr_seqs:
-            self._requeset_ids_num_curr_seqs.remove(req_id)
+        counted = self._request_ids_counted.get(req_id, 0)
+        if counted & _COUNTED_SEQS:
+            if counted == _COUNTED_SEQS:
+                del self._request_ids_counted[req_id]
+            else:
+                self._request_ids_counted[req_id] = _COUNTED_TOKENS
             self._num_curr_seqs -= num_curr_seqs
 
     @property
@@ -142,6 +178,9 @@ class SchedulingBudget:
 
 @dataclass
 class ScheduledSequenceGroup:
+    # Built for every scheduled group on every step; slots avoid a
+    # per-instance __dict__.
+    __slots__ = ("seq_group", "token_chunk_size")
     # A sequence group that's scheduled.
     seq_group: SequenceGroup
     # The total chunk size (number of tokens) to process for next iteration.
@@ -153,6 +192,13 @@ class ScheduledSequenceGroup:
 @dataclass
 class SchedulerOutputs:
     """The scheduling decision made from a scheduler."""
+    __slots__ = ("scheduled_seq_groups", "num_prefill_groups",
+                 "num_batched_tokens", "blocks_to_swap_in",
+                 "blocks_to_swap_out", "blocks_to_copy", "ignored_seq_groups",
+                 "num_lookahead_slots", "running_queue_size", "preempted",
+                 "num_waiting_to_running", "num_running_to_waiting",
+                 "recomputed_token_nums", "has_lora", "num_loras",
+                 "_lora_requests", "_nonempty_mask")
     # Scheduled sequence groups.
     scheduled_seq_groups: Iterable[ScheduledSequenceGroup]
     # Number of prefill groups scheduled.
@@ -175,36 +221,57 @@ class SchedulerOutputs:
     num_waiting_to_running: int
     num_running_to_waiting: int
     recomputed_token_nums: int
+    # Whether any scheduled group can carry a LoRA request. False when LoRA
+    # is disabled, in which case the LoRA bookkeeping below is skipped.
+    has_lora: bool
 
     def __post_init__(self):
         # Swap in and swap out should never happen at the same time.
         # assert not (self.blocks_to_swap_in and self.blocks_to_swap_out)
 
-        self.num_loras: int = len(self.lora_requests)
+        # One bit per non-empty piece of work, so `is_empty` is a single int
+        # compare on the engine step path.
+        self._nonempty_mask: int = (bool(self.scheduled_seq_groups)
+                                    | bool(self.blocks_to_swap_in) << 1
+                                    | bool(self.blocks_to_swap_out) << 2
+                                    | bool(self.blocks_to_copy) << 3)
+        if not self.has_lora:
+            self._lora_requests: Set[LoRARequest] = set()
+            self.num_loras: int = 0
+            return
+        # Computed once; `scheduled_seq_groups` is only reordered afterwards.
+        self._lora_requests = {
+            g.seq_group.lora_request
+            for g in self.scheduled_seq_groups
+            if g.seq_group.lora_request is not None
+        }
+        self.num_loras = len(self._lora_requests)
         if self.num_loras > 0:
             self._sort_by_lora_ids()
 
     def is_empty(self) -> bool:
         # NOTE: We do not consider the ignored sequence groups.
-        return (not self.scheduled_seq_groups and not self.blocks_to_swap_in
-                and not self.blocks_to_swap_out and not self.blocks_to_copy)
+        return self._nonempty_mask == 0
 
     def _sort_by_lora_ids(self):
-        self.scheduled_seq_groups = sorted(
-            self.scheduled_seq_groups,
-            key=lambda g: (g.seq_group.lora_int_id, g.seq_group.request_id))
+        self.scheduled_seq_groups = sorted(self.scheduled_seq_groups,
+                                           key=_LORA_SORT_KEY)
 
     @property
     def lora_requests(self) -> Set[LoRARequest]:
-        return {
-            g.seq_group.lora_request
-            for g in self.scheduled_seq_groups
-            if g.seq_group.lora_request is not None
-        }
+        return self._lora_requests
 
 
 @dataclass
 class SchedulerPreemption:
+    __slots__ = ("decode_seq_groups_running", "decode_seq_groups_swapped",
+                 "prefill_seq_groups_running", "prefill_seq_groups_swapped",
+                 "preempted_running", "swapped_out_running",
+                 "blocks_to_swap_in", "blocks_to_swap_out",
+                 "blocks_to_copy_running", "blocks_to_copy_swapped",
+                 "infeasible_seq_groups", "ignored_seq_groups",
+                 "seq_groups_prefill", "num_lookahead_slots_running",
+                 "num_lookahead_slots_swapped", "num_lookahead_slots_prefill")
     decode_seq_groups_running: List[SequenceGroup]
     decode_seq_groups_swapped: List[SequenceGroup]
     prefill_seq_groups_running: List[SequenceGroup]
@@ -230,6 +297,9 @@ class SchedulerRunningOutputs:
     Could contain prefill (prefill that's chunked) or decodes. If there's not
     enough memory, it can be preempted (for recompute) or swapped out.
     """
+    __slots__ = ("decode_seq_groups", "prefill_seq_groups", "preempted",
+                 "swapped_out", "blocks_to_swap_out", "blocks_to_copy",
+                 "num_lookahead_slots")
     # Selected sequences that are running and in a decoding phase.
     decode_seq_groups: List[SequenceGroup]
     # Selected sequences that are running and in a prefill phase.
@@ -265,6 +335,9 @@ class SchedulerSwappedInOutputs:
 
     Could contain prefill (prefill that's chunked) or decodes.
     """
+    __slots__ = ("decode_seq_groups", "prefill_seq_groups",
+                 "blocks_to_swap_in", "blocks_to_copy", "num_lookahead_slots",
+                 "infeasible_seq_groups")
     # Selected sequences that are going to be swapped in and is in a
     # decoding phase.
     decode_seq_groups: List[SequenceGroup]
@@ -299,6 +372,7 @@ class SchedulerPrefillOutputs:
     Could contain a fresh prefill requests or preempted requests that need
     to be recomputed from scratch.
     """
+    __slots__ = ("seq_groups", "ignored_seq_groups", "num_lookahead_slots")
     # Selected sequences for prefill.
     seq_groups: List[SequenceGroup]
     # Ignored sequence groups.
@@ -355,8 +429,14 @@ class Scheduler:
         # Sequence groups in the SWAPPED state.
         # Contain decode requests that are swapped out.
         self.swapped: Deque[SequenceGroup] = deque()
-        
-        self.half_swapped: PriorityQueue[(int, (int, SequenceGroup))] = PriorityQueue()
+        # Sequence groups that are only partially swapped out, keyed by
+        # request id. Values are (left_block_num, swap_out_block_num,
+        # seq_group).
+        self.partial_swapped: Dict[str, Tuple[int, int, SequenceGroup]] = {}
+        # Min-heap of (left_block_num, request_id) over `partial_swapped`.
+        # Entries that no longer match `partial_swapped` are stale and are
+        # dropped lazily when popped, so removal by request id is O(1).
+        self._partial_swapped_heap: List[Tuple[int, str]] = []
         # Time at previous scheduling step
         self.prev_time = 0.0
         # Did we schedule a prompt at previous step?
@@ -372,6 +452,11 @@ class Scheduler:
         self.artificial_preempt_cnt = (ARTIFICIAL_PREEMPTION_MAX_CNT
                                        if self.enable_artificial_preemption
                                        else 0)
+        # Bind the checking variant once so the regular path does not test
+        # the flag on every call.
+        self._can_append_slots_fn: Callable[[SequenceGroup], bool] = (
+            self._can_append_slots_with_artificial_preemption
+            if self.enable_artificial_preemption else self._can_append_slots)
         self.num_cumulative_preemption: int = 0
         self.preemption_mode: PreemptionMode = PreemptionMode.RECOMPUTE
 
@@ -381,6 +466,11 @@ class Scheduler:
             self.preemption_mode = PreemptionMode.RECOMPUTE
         self.iter_nums = 0
         self.has_finished_seqs = False
+        # Policies are stateless; resolve them once instead of per step.
+        self._fcfs_policy = PolicyFactory.get_policy(policy_name="fcfs")
+        self._policy = PolicyFactory.get_policy(
+            policy_name=self.scheduler_config.policy)
+        self._use_infer_policy = self.scheduler_config.policy == "infer"
 
     @property
     def lora_enabled(self) -> bool:
@@ -408,29 +498,85 @@ class Scheduler:
         Args:
             request_id: The ID(s) of the sequence group to abort.
         """
-        if isinstance(request_id, str):
-            request_id = (request_id, )
-        request_ids = set(request_id)
+        request_ids = ({request_id} if isinstance(request_id, str) else
+                       set(request_id))
         for state_queue in [self.waiting, self.running, self.swapped]:
+            if not request_ids:
+                break
             aborted_groups: List[SequenceGroup] = []
+            remaining_groups: List[SequenceGroup] = []
             for seq_group in state_queue:
-                if not request_ids:
-                    # Using 'break' here may add two extra iterations,
-                    # but is acceptable to reduce complexity.
-                    break
                 if seq_group.request_id in request_ids:
                     # Appending aborted group into pending list.
                     aborted_groups.append(seq_group)
                     request_ids.remove(seq_group.request_id)
+                else:
+                    remaining_groups.append(seq_group)
+            if not aborted_groups:
+                continue
+            # Rebuild the state queue in place with a single pass instead of
+            # an O(n) `deque.remove` per aborted group.
+            state_queue.clear()
+            state_queue.extend(remaining_groups)
             for aborted_group in aborted_groups:
-                # Remove the sequence group from the state queue.
-                state_queue.remove(aborted_group)
+                self.partial_swapped.pop(aborted_group.request_id, None)
                 for seq in aborted_group.get_seqs():
                     if seq.is_finished():
                         continue
                     seq.status = SequenceStatus.FINISHED_ABORTED
                     self.free_seq(seq)
 
+    def _insert_seq_group_into_partial_swapped(
+            self, seq_group: SequenceGroup, left_block_num: int,
+            swap_out_block_num: int) -> None:
+        self.partial_swapped[seq_group.request_id] = (left_block_num,
+                                                      swap_out_block_num,
+                                                      seq_group)
+        if len(self._partial_swapped_heap) > 2 * len(self.partial_swapped):
+            # Too many stale entries; rebuild from the live ones.
+            self._partial_swapped_heap = [
+                (entry[0], request_id)
+                for request_id, entry in self.partial_swapped.items()
+            ]
+            heapq.heapify(self._partial_swapped_heap)
+        else:
+            heapq.heappush(self._partial_swapped_heap,
+                           (left_block_num, seq_group.request_id))
+
+    def _get_seq_group_from_partial_swapped(
+            self) -> Optional[Tuple[int, int, SequenceGroup]]:
+        """Pop the partially swapped sequence group with the fewest blocks
+        left on GPU, or return None if there is none."""
+        while self._partial_swapped_heap:
+            left_block_num, request_id = heapq.heappop(
+                self._partial_swapped_heap)
+            entry = self.partial_swapped.get(request_id)
+            if entry is not None and entry[0] == left_block_num:
+                del self.partial_swapped[request_id]
+                return entry
+        return None
+
+    def _swap_out_partial_swapped(
+            self, blocks_to_swap_out: List[Tuple[int, int]]) -> bool:
+        """Swap out the blocks the partially swapped group with the fewest
+        blocks left on GPU still holds there.
+
+        The group is already SWAPPED and in `self.swapped`, so it is not
+        reported as swapped out again. Returns True if any GPU block was
+        freed."""
+        while True:
+            partial_swapped = self._get_seq_group_from_partial_swapped()
+            if partial_swapped is None:
+                return False
+            seq_group = partial_swapped[2]
+            if not self.block_manager.can_swap_out(seq_group):
+                # No CPU space; its blocks stay on GPU until it swaps in.
+                continue
+            mapping = self.block_manager.swap_out_remaining(seq_group)
+            if mapping:
+                blocks_to_swap_out.extend(mapping)
+                return True
+
     def has_unfinished_seqs(self) -> bool:
         return len(self.waiting) != 0 or len(self.running) != 0 or len(
             self.swapped) != 0
@@ -454,6 +600,8 @@ class Scheduler:
         recomputed_token_nums: int = 0
         preempted: List[SequenceGroup] = []
         swapped_out: List[SequenceGroup] = []
+        swap_out_partial_tokens = self.scheduler_config.swap_out_partial_tokens
+        swap_out_partial_rate = self.scheduler_config.swap_out_partial_rate
 
         # NOTE(woosuk): Preemption happens only when there is no available slot
         # to keep all the sequence groups in the RUNNING state.
@@ -463,50 +611,57 @@ class Scheduler:
             running_queue = policy.sort_by_priority(None, running_queue)
             self.has_finished_seqs = False
         while running_queue:
-            seq_group: SequenceGroup = running_queue[0]
+            seq_group: SequenceGroup = running_queue.popleft()
             num_running_tokens = self._get_num_new_tokens(
                 seq_group, SequenceStatus.RUNNING, enable_chunking, budget)
 
             if num_running_tokens == 0:
+                # Out of token budget; leave the group at the head.
+                running_queue.appendleft(seq_group)
                 break
 
-            running_queue.popleft()
-
-            if not self._can_append_slots(seq_group):
+            if not self._can_append_slots_fn(seq_group):
+                # Reclaim the blocks a partially swapped group still holds on
+                # GPU before preempting anything else, then retry.
+                if (swap_out_partial_tokens and
+                        self._swap_out_partial_swapped(blocks_to_swap_out)):
+                    running_queue.appendleft(seq_group)
+                    continue
                 swap_out_block_num = -1
+                # Blocks left on GPU if `seq_group` ends up partially swapped.
+                left_block_num = 0
                 # If there's no other sequence groups in the waiting queue, only
                 # swap out half of the tokens belong to current seq_group.
-                if self.scheduler_config.swap_out_partial_tokens:
-                    if not self.half_swapped.empty():
-                        (left_tokens,(block_size,half_swapped_seq_group)) = self.swapped.popleft()
-                        budget.subtract_num_batched_tokens(half_swapped_seq_group.request_id, left_tokens)
-                        swap_out_block_num = block_size
-                        swap_out_seq_group = half_swapped_seq_group
+                if swap_out_partial_tokens:
+                    if len(self.waiting) > 0:
+                        budget.subtract_num_batched_tokens(seq_group.request_id,
+                                                        num_running_tokens)
                     else:
-                        if len(self.waiting) > 0:
-                            budget.subtract_num_batched_tokens(seq_group.request_id,
-                                                            num_running_tokens)
-                            swap_out_seq_group = seq_group
-                        else:
-                            budget.subtract_num_batched_tokens(seq_group.request_id,
-                                                            max(int(num_running_tokens * self.scheduler_config.swap_out_partial_rate),1))
-                            # if seq_group.total_token_block_size > 120:
-                            swap_out_block_num = max(
-                                int(seq_group.total_token_block_size * self.scheduler_config.swap_out_partial_rate), 1)
-                            left_block_num = seq_group.total_token_block_size - swap_out_block_num
-                            if left_block_num >0:
-                                self.half_swapped.put((left_block_num, (swap_out_block_num, seq_group)))
-                            swap_out_seq_group = seq_group
+                        swap_out_tokens = int(num_running_tokens *
+                                              swap_out_partial_rate)
+                        budget.subtract_num_batched_tokens(
+                            seq_group.request_id,
+                            swap_out_tokens if swap_out_tokens > 0 else 1)
+                        # total_token_block_size is a property that walks
+                        # the sequences; read it once.
+                        total_token_block_size = (
+                            seq_group.total_token_block_size)
+                        # if total_token_block_size > 120:
+                        swap_out_block_num = int(total_token_block_size *
+                                                 swap_out_partial_rate)
+                        if swap_out_block_num < 1:
+                            swap_out_block_num = 1
+                        left_block_num = (total_token_block_size -
+                                          swap_out_block_num)
                 else:
                     budget.subtract_num_batched_tokens(seq_group.request_id,
                                                         num_running_tokens) 
-                    swap_out_seq_group = seq_group
                 num_running_seqs = seq_group.get_max_num_running_seqs()
                 seq_group.update_waiting_iter_nums()
                 budget.subtract_num_seqs(seq_group.request_id,
                                          num_running_seqs)
                 preempted_mode = self._preempt(
-                    swap_out_seq_group,
+                    seq_group,
                     blocks_to_swap_out,
                     self.preemption_mode,
                     swap_out_block_num=swap_out_block_num)
@@ -514,7 +669,12 @@ class Scheduler:
                 if preempted_mode == PreemptionMode.RECOMPUTE:
                     preempted.append(seq_group)
                 else:
-                    swapped_out.append(swap_out_seq_group)
+                    swapped_out.append(seq_group)
+                    if left_block_num > 0:
+                        # Only a partial swap-out leaves blocks behind to
+                        # reclaim from this group later.
+                        self._insert_seq_group_into_partial_swapped(
+                            seq_group, left_block_num, swap_out_block_num)
 
             else:
                 self._append_slots(seq_group, blocks_to_copy)
@@ -581,6 +741,17 @@ class Scheduler:
             A tuple of remaining running queue (should be always 0) after
             scheduling and SchedulerRunningOutputs.
         """
+        if not running_queue:
+            # Idle step: nothing to sort, schedule or preempt.
+            return deque(), SchedulerRunningOutputs(
+                decode_seq_groups=[],
+                prefill_seq_groups=[],
+                preempted=[],
+                swapped_out=[],
+                blocks_to_swap_out=[],
+                blocks_to_copy=[],
+                num_lookahead_slots=self._get_num_lookahead_slots(
+                    is_prefill=False)), 0
         # Blocks that need to be swapped or copied before model execution.
         blocks_to_swap_out: List[Tuple[int, int]] = []
         blocks_to_copy: List[Tuple[int, int]] = []
@@ -595,36 +766,51 @@ class Scheduler:
         # to keep all the sequence groups in the RUNNING state.
         # In this case, the policy is responsible for deciding which sequence
         # groups to preempt.
+        swap_out_partial_tokens = self.scheduler_config.swap_out_partial_tokens
+        swap_out_partial_rate = self.scheduler_config.swap_out_partial_rate
         now = time.time()
         running_queue = policy.sort_by_priority(now, running_queue)
         while running_queue:
-            seq_group: SequenceGroup = running_queue[0]
+            seq_group: SequenceGroup = running_queue.popleft()
             num_running_tokens = self._get_num_new_tokens(
                 seq_group, SequenceStatus.RUNNING, enable_chunking, budget)
 
             if num_running_tokens == 0:
+                # Out of token budget; leave the group at the head.
+                running_queue.appendleft(seq_group)
                 break
 
-            running_queue.popleft()
-
-            while not self._can_append_slots(seq_group):
+            # Both depend only on `seq_group`, which stays fixed while victims
+            # are preempted below; compute them on the first preemption only.
+            num_running_seqs = -1
+            partial_swap_out_block_num = -1
+            while not self._can_append_slots_fn(seq_group):
                 swap_out_block_num = -1
-                if self.scheduler_config.swap_out_partial_tokens:
+                if swap_out_partial_tokens:
                     if len(self.waiting) > 0:
                         budget.subtract_num_batched_tokens(seq_group.request_id,
                                                         num_running_tokens)
                     else:
-                        budget.subtract_num_batched_tokens(seq_group.request_id,
-                                                        max(int(num_running_tokens*self.scheduler_config.swap_out_partial_rate),1))
+                        swap_out_tokens = int(num_running_tokens *
+                                              swap_out_partial_rate)
+                        budget.subtract_num_batched_tokens(
+                            seq_group.request_id,
+                            swap_out_tokens if swap_out_tokens > 0 else 1)
                         # if seq_group.total_token_block_size > 120:
-                        swap_out_block_num = max(
-                            int(seq_group.total_token_block_size * self.scheduler_config.swap_out_partial_rate), 1)
+                        if partial_swap_out_block_num < 0:
+                            partial_swap_out_block_num = int(
+                                seq_group.total_token_block_size *
+                                swap_out_partial_rate)
+                            if partial_swap_out_block_num < 1:
+                                partial_swap_out_block_num = 1
+                        swap_out_block_num = partial_swap_out_block_num
                 else:
                     budget.subtract_num_batched_tokens(seq_group.request_id,
                                                         num_running_tokens) 
                 # budget.subtract_num_batched_tokens(seq_group.request_id,
                 #                                    num_running_tokens)
-                num_running_seqs = seq_group.get_max_num_running_seqs()
+                if num_running_seqs < 0:
+                    num_running_seqs = seq_group.get_max_num_running_seqs()
                 budget.subtract_num_seqs(seq_group.request_id,
                                          num_running_seqs)
                 if curr_loras is not None and seq_group.lora_int_id > 0:
@@ -738,8 +924,11 @@ class Scheduler:
         blocks_to_copy: List[Tuple[int, int]] = []
         decode_seq_groups: List[ScheduledSequenceGroup] = []
         prefill_seq_groups: List[ScheduledSequenceGroup] = []
-        now = time.time()
-        swapped_queue = policy.sort_by_priority(now, swapped_queue)
+        if len(swapped_queue) > 1:
+            swapped_queue = policy.sort_by_priority(time.time(), swapped_queue)
+        else:
+            # Nothing to order; still copy so the input is not modified.
+            swapped_queue = deque(swapped_queue)
         infeasible_seq_groups: List[SequenceGroup] = []
 
         leftover_swapped: Deque[SequenceGroup] = deque()
@@ -798,7 +987,8 @@ class Scheduler:
             swapped_queue.popleft()
             self._swap_in(seq_group, blocks_to_swap_in)
             self._append_slots(seq_group, blocks_to_copy)
-            is_prefill = seq_group.is_prefill()
+            # Swapping in and appending slots leave the stage unchanged, so
+            # `is_prefill` from the can_swap_in check above still holds.
             if is_prefill:
                 prefill_seq_groups.append(
                     ScheduledSequenceGroup(seq_group,
@@ -873,13 +1063,19 @@ class Scheduler:
         """
         ignored_seq_groups: List[SequenceGroup] = []
         seq_groups: List[SequenceGroup] = []
-        # We don't sort waiting queue because we assume it is sorted.
-        # Copy the queue so that the input queue is not modified.
-        waiting_queue = deque([s for s in waiting_queue])
-        if policy is not None:
-            waiting_queue = policy.sort_by_priority(time.time(), waiting_queue)
+        # One timestamp for the whole pass: the sort and every delay check.
+        now = time.time()
+        # Copy the queue so that the input queue is not modified. Sorting
+        # already returns a new deque, so only copy when there is no policy.
+        if policy is not None and len(waiting_queue) > 1:
+            waiting_queue = policy.sort_by_priority(now, waiting_queue)
+        else:
+            waiting_queue = deque(waiting_queue)
         leftover_waiting_sequences: Deque[SequenceGroup] = deque()
-        while self._passed_delay(time.time()) and waiting_queue:
+        # `now`, self.waiting and self.running do not change within this
+        # pass, so the delay check has the same answer on every iteration.
+        passed_delay = self._passed_delay(now)
+        while passed_delay and waiting_queue:
             seq_group = waiting_queue[0]
 
             waiting_seqs = seq_group.get_seqs(status=SequenceStatus.WAITING)
@@ -889,9 +1085,9 @@ class Scheduler:
             num_new_tokens = self._get_num_new_tokens(seq_group,
                                                       SequenceStatus.WAITING,
                                                       enable_chunking, budget)
-            if not enable_chunking:
-                num_prompt_tokens = waiting_seqs[0].get_len()
-                assert num_new_tokens == num_prompt_tokens
+            # Folded into the assert so `python -O` skips get_len() too.
+            assert (enable_chunking
+                    or num_new_tokens == waiting_seqs[0].get_len())
 
             prompt_limit = self._get_prompt_limit(seq_group)
             if num_new_tokens > prompt_limit:
@@ -994,7 +1190,7 @@ class Scheduler:
             remaining_waiting, prefills = self._schedule_prefills(
                 self.waiting, budget, curr_loras, enable_chunking=False)
 
-        policy = PolicyFactory.get_policy(policy_name="fcfs")
+        policy = self._fcfs_policy
         # Don't schedule decodes if prefills are scheduled.
         # NOTE: If `_schedule_prefills` doesn't enable chunking, self.running
         # only contains decode requests, not chunked prefills.
@@ -1022,11 +1218,10 @@ class Scheduler:
         self.waiting.extendleft(running_scheduled.preempted)
         # Update new running requests.
         self.running = remaining_running
-        self.running.extend([s.seq_group for s in prefills.seq_groups])
         self.running.extend(
-            [s.seq_group for s in running_scheduled.decode_seq_groups])
-        self.running.extend(
-            [s.seq_group for s in swapped_in.decode_seq_groups])
+            map(_SEQ_GROUP,
+                chain(prefills.seq_groups, running_scheduled.decode_seq_groups,
+                      swapped_in.decode_seq_groups)))
         # Update swapped requests.
         self.swapped = remaining_swapped
         self.swapped.extend(running_scheduled.swapped_out)
@@ -1055,6 +1250,7 @@ class Scheduler:
             num_running_to_waiting=0,
             num_waiting_to_running=0,
             recomputed_token_nums=0,
+            has_lora=self.lora_enabled,
         )
 
     def _schedule_chunked_prefill(self):
@@ -1088,9 +1284,8 @@ class Scheduler:
             self.running, SchedulerRunningOutputs.create_empty())
         remaining_swapped, swapped_in = (
             self.swapped, SchedulerSwappedInOutputs.create_empty())
-        policy = PolicyFactory.get_policy(
-            policy_name=self.scheduler_config.policy)
-        if self.scheduler_config.policy == "infer":
+        policy = self._policy
+        if self._use_infer_policy:
             remaining_running, running_scheduled, recomputed_token_nums = \
                 self._schedule_running_preemption(self.running, 
                                                   budget, 
@@ -1130,15 +1325,12 @@ class Scheduler:
         self.waiting.extendleft(running_scheduled.preempted)
         # Update new running requests.
         self.running = remaining_running
-        self.running.extend([s.seq_group for s in prefills.seq_groups])
-        self.running.extend(
-            [s.seq_group for s in running_scheduled.decode_seq_groups])
         self.running.extend(
-            [s.seq_group for s in running_scheduled.prefill_seq_groups])
-        self.running.extend(
-            [s.seq_group for s in swapped_in.decode_seq_groups])
-        self.running.extend(
-            [s.seq_group for s in swapped_in.prefill_seq_groups])
+            map(_SEQ_GROUP,
+                chain(prefills.seq_groups, running_scheduled.decode_seq_groups,
+                      running_scheduled.prefill_seq_groups,
+                      swapped_in.decode_seq_groups,
+                      swapped_in.prefill_seq_groups)))
         # Update swapped requests.
         self.swapped = remaining_swapped
         self.swapped.extend(running_scheduled.swapped_out)
@@ -1165,6 +1357,7 @@ class Scheduler:
             num_running_to_waiting=len(running_scheduled.preempted),
             num_waiting_to_running=len(running_scheduled.prefill_seq_groups),
             recomputed_token_nums=recomputed_token_nums,
+            has_lora=self.lora_enabled,
         )
 
     def _schedule(self) -> SchedulerOutputs:
@@ -1178,13 +1371,6 @@ class Scheduler:
         """Determine whether or not we have enough space in the KV cache to
         continue generation of the sequence group.
         """
-        # It is True only for testing case to trigger artificial preemption.
-        if (self.enable_artificial_preemption
-                and random.uniform(0, 1) < ARTIFICIAL_PREEMPTION_PROB
-                and self.artificial_preempt_cnt > 0):
-            self.artificial_preempt_cnt -= 1
-            return False
-
         # Appending slots only occurs in decoding.
         is_prefill = False
 
@@ -1193,6 +1379,17 @@ class Scheduler:
             num_lookahead_slots=self._get_num_lookahead_slots(is_prefill),
         )
 
+    def _can_append_slots_with_artificial_preemption(
+            self, seq_group: SequenceGroup) -> bool:
+        """`_can_append_slots` that also fails with
+        ARTIFICIAL_PREEMPTION_PROB probability to trigger preemption. Only
+        used in tests."""
+        if (self.artificial_preempt_cnt > 0 and random.getrandbits(32) <
+                _ARTIFICIAL_PREEMPTION_THRESHOLD):
+            self.artificial_preempt_cnt -= 1
+            return False
+        return self._can_append_slots(seq_group)
+
     def _can_append_slots_prefill(self, seq_group: SequenceGroup) -> bool:
         return self.block_manager.can_append_slots(
             seq_group=seq_group,
@@ -1211,6 +1408,10 @@ class Scheduler:
         #     self.current_num_seqs = self.scheduler_config.max_num_seqs//2
         scheduler_outputs = self._schedule()
         now = time.time()
+        # Block access times and computed-block marks only feed prefix
+        # caching; every block manager ignores them when it is off.
+        track_block_access = self.cache_config.enable_prefix_caching
+        has_prefill_groups = scheduler_outputs.num_prefill_groups > 0
         
         # Create input data structures.
         seq_group_metadata_list: List[SequenceGroupMetadata] = []
@@ -1225,18 +1426,22 @@ class Scheduler:
             seq_data: Dict[int, SequenceData] = {}
             # seq_id -> physical block numbers
             block_tables: Dict[int, List[int]] = {}
-            for seq in seq_group.get_seqs(status=SequenceStatus.RUNNING):
+            running_seqs = seq_group.get_seqs(status=SequenceStatus.RUNNING)
+            for seq in running_seqs:
                 seq_id = seq.seq_id
                 seq_data[seq_id] = seq.data
                 block_tables[seq_id] = self.block_manager.get_block_table(seq)
-                self.block_manager.access_all_blocks_in_seq(seq, now)
+                if track_block_access:
+                    self.block_manager.access_all_blocks_in_seq(seq, now)
 
             common_computed_block_nums = (
-                self.block_manager.get_common_computed_block_ids(
-                    seq_group.get_seqs(status=SequenceStatus.RUNNING)))
+                self.block_manager.get_common_computed_block_ids(running_seqs))
 
             do_sample = True
-            if seq_group.is_prefill():
+            # It assumes the scheduled_seq_groups is ordered by
+            # prefill < decoding.
+            is_prompt = seq_group.is_prefill()
+            if is_prompt:
                 seqs = seq_group.get_seqs()
                 # Prefill has only 1 sequence.
                 assert len(seqs) == 1
@@ -1245,13 +1450,11 @@ class Scheduler:
                 # NOTE: We use get_len instead of get_prompt_len because when
                 # a sequence is preempted, prefill includes previous generated
                 # output tokens.
-                if (token_chunk_size + seqs[0].data.get_num_computed_tokens() <
-                        seqs[0].data.get_len()):
+                prompt_data = seqs[0].data
+                if (token_chunk_size + prompt_data.get_num_computed_tokens() <
+                        prompt_data.get_len()):
                     do_sample = False
 
-            # It assumes the scheduled_seq_groups is ordered by
-            # prefill < decoding.
-            is_prompt = seq_group.is_prefill()
             seq_group_metadata = SequenceGroupMetadata(
                 request_id=seq_group.request_id,
                 is_prompt=is_prompt,
@@ -1269,7 +1472,7 @@ class Scheduler:
                 # the subsequent comms can still use delta, but
                 # `multi_modal_data` will be None.
                 multi_modal_data=seq_group.multi_modal_data
-                if scheduler_outputs.num_prefill_groups > 0 else None,
+                if has_prefill_groups else None,
                 eos_token_id=seq_group.eos_token_id)
             seq_group_metadata_list.append(seq_group_metadata)
 
@@ -1277,9 +1480,11 @@ class Scheduler:
         # batch will have been computed before the next scheduling invocation.
         # This is because the engine assumes that a failure in model execution
         # will crash the vLLM instance / will not retry.
-        for scheduled_seq_group in scheduler_outputs.scheduled_seq_groups:
-            self.block_manager.mark_blocks_as_computed(
-                scheduled_seq_group.seq_group)
+        # Like the access times above, this only matters for prefix caching.
+        if track_block_access:
+            for scheduled_seq_group in scheduler_outputs.scheduled_seq_groups:
+                self.block_manager.mark_blocks_as_computed(
+                    scheduled_seq_group.seq_group)
         return seq_group_metadata_list, scheduler_outputs
 
     def fork_seq(self, parent_seq: Sequence, child_seq: Sequence) -> None:
@@ -1290,8 +1495,11 @@ class Scheduler:
         self.block_manager.free(seq)
 
     def free_finished_seq_groups(self) -> None:
-        self.running = deque(seq_group for seq_group in self.running
-                             if not seq_group.is_finished())
+        # Most decode steps finish nothing; only rebuild the queue when a
+        # group actually has to be dropped.
+        if any(seq_group.is_finished() for seq_group in self.running):
+            self.running = deque(seq_group for seq_group in self.running
+                                 if not seq_group.is_finished())
         self.has_finished_seqs = True
 
     def _allocate_and_set_running(self, seq_group: SequenceGroup) -> None:
@@ -1394,6 +1602,7 @@ class Scheduler:
     ) -> None:
         mapping = self.block_manager.swap_in(seq_group)
         blocks_to_swap_in.extend(mapping)
+        self.partial_swapped.pop(seq_group.request_id, None)
         for seq in seq_group.get_seqs(status=SequenceStatus.SWAPPED):
             seq.status = SequenceStatus.RUNNING
 
@@ -1419,8 +1628,8 @@ class Scheduler:
         self.prev_time, self.prev_prompt = now, False
         # Delay scheduling prompts to let waiting queue fill up
         if self.scheduler_config.delay_factor > 0 and self.waiting:
-            earliest_arrival_time = min(
-                [e.metrics.arrival_time for e in self.waiting])
+            earliest_arrival_time = min(e.metrics.arrival_time
+                                        for e in self.waiting)
             passed_delay = (
                 (now - earliest_arrival_time) >
                 (self.scheduler_config.delay_factor * self.last_prompt_latency)
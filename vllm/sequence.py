@@ -505,10 +505,13 @@ class SequenceGroup:
 
     @property
     def total_token_block_size(self) -> int:
-        if self.is_prefill():
+        # Read straight off seqs_dict; is_prefill() and get_seqs() would each
+        # build a throwaway list of the sequences.
+        seqs_dict = self.seqs_dict
+        if next(iter(seqs_dict.values())).is_prefill():
             return self._total_token_block_size
         else:
-            return self._total_token_block_size + len(self.get_seqs())
+            return self._total_token_block_size + len(seqs_dict)
 
     def get_last_latency(self, now: float) -> Optional[float]:
         """Sets the last token time for Request level timings."""